@@ -1,14 +1,30 @@
 import argparse
+import contextlib
+import functools
+import hashlib
 import os
+import pickle
 import string
-from typing import List, Tuple
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import FrozenSet, List, Optional, Tuple
 
 import nltk
-from Levenshtein import ratio, seqratio
+import numpy as np
 from nltk.corpus import stopwords
 from pybtex.database import BibliographyData
 from pybtex.database.input import bibtex
-from sklearn.feature_extraction.text import TfidfVectorizer
+from rapidfuzz import fuzz, process
+from rapidfuzz.distance import Indel
+from scipy.optimize import linear_sum_assignment
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+
+# replaces line breaks by spaces and removes punctuation (including apostrophes)
+_CLEANUP_TABLE = str.maketrans('\n\r', '  ', string.punctuation)
+
+# directory of the preprocessed entries, the version is part of the key to invalidate outdated caches
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'bibtex-merge')
+_CACHE_VERSION = 1
 
 
 def parse_args() -> argparse.Namespace:
@@ -60,9 +76,11 @@ def parse_bibtex_files(path_bib_1: str, path_bib_2: str, path_output: str, overw
         raise FileNotFoundError(f'Specified path of bib file 2 (\'{path_bib_2}\') does not exist.')
     if os.path.exists(path_output) and not overwrite:
         raise FileExistsError(f'Specified output path (\'{path_output}\') does already exist.')
-    # load both bib files
-    bib_file_1 = bibtex.Parser(encoding='utf-8').parse_file(path_bib_1)
-    bib_file_2 = bibtex.Parser(encoding='utf-8').parse_file(path_bib_2)
+    # load both bib files concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_1 = executor.submit(bibtex.Parser(encoding='utf-8').parse_file, path_bib_1)
+        future_2 = executor.submit(bibtex.Parser(encoding='utf-8').parse_file, path_bib_2)
+        bib_file_1, bib_file_2 = future_1.result(), future_2.result()
     if bib_file_1 is not None and bib_file_2 is not None:
         print('Successfully loaded both bibtex files. Starting analysis.')
 
@@ -82,36 +100,36 @@ def serialize_bibtex_entries(merged_keys: List[Tuple[str, str]], b_file_1: Bibli
     :param dry_run: whether to perform a dry run, i.e., write nothing into files, only print
     """
 
-    if not dry_run:
-        f = open(path_output, 'w', encoding='utf-8')
-        f.write('%%%%%%%%%%%%%%%%%%%%%%%\n')
-        f.write('%%% GENERATED BY MH %%%\n')
-        f.write('%%%%%%%%%%%%%%%%%%%%%%%\n')
-        f.write('\n')
+    chunks = ['%%%%%%%%%%%%%%%%%%%%%%%\n',
+              '%%% GENERATED BY MH %%%\n',
+              '%%%%%%%%%%%%%%%%%%%%%%%\n',
+              '\n']
 
+    entries_1 = b_file_1.entries
+    entries_2 = b_file_2.entries
     for i, (key_1, key_2) in enumerate(merged_keys):
         if prefer_second:
-            entry_to_serialize = b_file_2.entries[key_2]
-            comment_entry = b_file_1.entries[key_1]
+            entry_to_serialize = entries_2[key_2]
+            comment_entry = entries_1[key_1]
             print(f'Key \'{key_2}\': Writing entry from bibtex file 2 and comment for bibtex file 1.')
         else:
-            entry_to_serialize = b_file_1.entries[key_1]
-            comment_entry = b_file_2.entries[key_2]
+            entry_to_serialize = entries_1[key_1]
+            comment_entry = entries_2[key_2]
             print(f'Key \'{key_1}\': Writing entry from bibtex file 1 and comment from bibtex file 2.')
 
         # serialize
         if not dry_run:
-            f.write(f'%%% START GROUP {i} %%%\n\n')
-            f.write(entry_to_serialize.to_string('bibtex'))
-            f.write('\n')
+            ser_entry: str = entry_to_serialize.to_string('bibtex')
             ser_comm_entry: str = comment_entry.to_string('bibtex')
             ser_comm_entry = ser_comm_entry[1:]  # alter original type to avoid problems with some parsers
             ser_comm_entry = '%' + ser_comm_entry.strip().replace('\n', '\n%') + '\n\n'  # add every line as comment
-            f.write(ser_comm_entry)
-            f.write(f'%%% END GROUP {i} %%%\n\n')
+            chunks.extend([f'%%% START GROUP {i} %%%\n\n', ser_entry, '\n', ser_comm_entry,
+                           f'%%% END GROUP {i} %%%\n\n'])
 
+    # write everything at once
     if not dry_run:
-        f.close()
+        with open(path_output, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.write(''.join(chunks))
 
 
 def process_identical_keys(b_file_1: BibliographyData, b_file_2: BibliographyData, path_output: str,
@@ -139,6 +157,22 @@ def process_identical_keys(b_file_1: BibliographyData, b_file_2: BibliographyDat
         print('Found no identical keys.')
 
 
+@functools.lru_cache(maxsize=None)
+def _get_stopwords() -> FrozenSet[str]:
+    """
+    Loads the english stopwords from nltk and downloads them only if they are not available yet.
+    The stopwords are loaded lazily, so that only the similarity-based merge requires the corpus.
+    :return: the set of english stopwords
+    """
+
+    try:
+        nltk.data.find('corpora/stopwords')
+    except LookupError:
+        nltk.download('stopwords', quiet=True)
+    return frozenset(stopwords.words('english'))
+
+
+@functools.lru_cache(maxsize=None)
 def cleanup_text(text: str) -> str:
     """
     Cleans up the given text by removing line breaks, punctuation, and stopwords.
@@ -146,20 +180,103 @@ def cleanup_text(text: str) -> str:
     :return: the text after cleaning up
     """
 
-    # cleanup
-    new_text = text.replace('\n', ' ').replace('\r', ' ').replace('\'', '')
-
-    # remove punctuation
-    new_text = ''.join([c for c in new_text if c not in string.punctuation])
+    # cleanup and remove punctuation
+    new_text = text.translate(_CLEANUP_TABLE)
 
     # remove stopwords
-    new_text = ' '.join([w for w in new_text.split() if w.lower() not in list(stopwords.words('english'))])
+    english_stopwords = _get_stopwords()
+    new_text = ' '.join([w for w in new_text.split() if w.lower() not in english_stopwords])
 
     return new_text.lower()
 
 
+def _load_cached_features(cache_path: str, num_entries: int) -> Optional[Tuple[List[str], List[str], List[str]]]:
+    """
+    Loads the cached features of the entries of a bibtex file.
+    :param cache_path: the path to the cache file
+    :param num_entries: the number of entries of the bibtex file
+    :return: the cached features, or None if the cache does not exist or is corrupted
+    """
+
+    try:
+        with open(cache_path, 'rb') as f:
+            features = pickle.load(f)
+    except Exception:
+        return None  # any error of a corrupted cache is treated like a missing cache
+
+    # check the shape of the features, a corrupted cache might still be unpickled successfully
+    if not isinstance(features, tuple) or len(features) != 3 \
+            or not all(isinstance(feature, list) and len(feature) == num_entries for feature in features):
+        return None
+    return features
+
+
+def _store_cached_features(cache_path: str, features: Tuple[List[str], List[str], List[str]]):
+    """
+    Stores the features of the entries of a bibtex file in the cache.
+    The cache is only an optimization, so failing to write it is ignored. The features are written to a temporary
+    file first to avoid that concurrent runs read a partially written cache.
+    :param cache_path: the path to the cache file
+    :param features: the features to cache
+    """
+
+    tmp_path = None
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=_CACHE_DIR, suffix='.tmp', delete=False) as f:
+            tmp_path = f.name
+            pickle.dump(features, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if tmp_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+
+
+def preprocess_entries(b_file: BibliographyData, path_bib: Optional[str] = None) \
+        -> Tuple[List[str], List[str], List[str]]:
+    """
+    Extracts the features of all entries that are compared in order to find similar entries.
+    If the path of the bibtex file is given, the features are cached on disk with the hash of the file as key.
+    :param b_file: the parsed bibtex file
+    :param path_bib: the path to the bibtex file, or None to disable caching
+    :return: a triple of the cleaned titles, the last names of the authors, and the texts of all fields
+    """
+
+    cache_path = None
+    if path_bib is not None:
+        with open(path_bib, 'rb') as f:
+            file_hash = hashlib.md5(f.read() + str(_CACHE_VERSION).encode()).hexdigest()
+        cache_path = os.path.join(_CACHE_DIR, f'{file_hash}.pkl')
+        features = _load_cached_features(cache_path, len(b_file.entries))
+        if features is not None:
+            return features
+
+    def get_last_names(entry) -> List[str]:
+        authors = entry.persons.get('author', [])
+        last_names = []
+        for a1 in authors:
+            last_names.extend(a1.last_names)
+        return last_names
+
+    def get_all_fields(entry) -> str:
+        return ' '.join(entry.fields.values())
+
+    # extract all features in a single pass over the entries
+    titles, names, texts = [], [], []
+    for entry in b_file.entries.values():
+        titles.append(cleanup_text(entry.fields.get('title', '')))
+        names.append(' '.join(get_last_names(entry)).lower())
+        texts.append(get_all_fields(entry))
+
+    if cache_path is not None:
+        _store_cached_features(cache_path, (titles, names, texts))
+
+    return titles, names, texts
+
+
 def process_similar_keys(b_file_1: BibliographyData, b_file_2: BibliographyData, path_output: str, prefer_second: bool,
-                         dry_run: bool):
+                         dry_run: bool, path_bib_1: Optional[str] = None, path_bib_2: Optional[str] = None):
     """
     Processes the case where similar entries should be matched.
     :param b_file_1: the first parsed bibtex file
@@ -167,6 +284,8 @@ def process_similar_keys(b_file_1: BibliographyData, b_file_2: BibliographyData,
     :param path_output: the path to the output file
     :param prefer_second: whether the entry from the first or the second file should be exported
     :param dry_run: whether to perform a dry run, i.e., write nothing into files, only print
+    :param path_bib_1: the path to the first bibtex file, used to cache its preprocessed entries
+    :param path_bib_2: the path to the second bibtex file, used to cache its preprocessed entries
     """
 
     print('I am looking for similar entries.')
@@ -174,70 +293,49 @@ def process_similar_keys(b_file_1: BibliographyData, b_file_2: BibliographyData,
     b_keys_1 = list(b_file_1.entries.keys())
     b_keys_2 = list(b_file_2.entries.keys())
 
-    # compare title with Levenshtein similarity
-    title_sims = {}
-    for k1 in b_keys_1:
-        title_1 = b_file_1.entries[k1].fields['title']
-        for k2 in b_keys_2:
-            title_2 = b_file_2.entries[k2].fields['title']
-            title_sims[(k1, k2)] = ratio(cleanup_text(title_1), cleanup_text(title_2))
+    # nothing can be matched if one of the files is empty
+    if not b_keys_1 or not b_keys_2:
+        serialize_bibtex_entries([], b_file_1, b_file_2, path_output, prefer_second, dry_run)
+        return
 
-    # compare authors with sequence similarity
-    def get_last_names(entry) -> List[str]:
-        authors = entry.persons['author']
-        last_names = []
-        for a1 in authors:
-            last_names.extend(a1.last_names)
-        return last_names
+    titles_1, names_1, texts_1 = preprocess_entries(b_file_1, path_bib_1)
+    titles_2, names_2, texts_2 = preprocess_entries(b_file_2, path_bib_2)
 
-    author_sims = {}
-    for k1 in b_keys_1:
-        last_names_1 = get_last_names(b_file_1.entries[k1])
-        for k2 in b_keys_2:
-            last_names_2 = get_last_names(b_file_2.entries[k2])
-            author_sims[(k1, k2)] = seqratio(last_names_1, last_names_2)
+    # compare title with Levenshtein similarity (normalized indel similarity, computed for all pairs at once)
+    # a pair can only reach the aggregated threshold of 0.7 if its title similarity is at least
+    # (0.7 - 0.375 - 0.25) / 0.375 = 0.2, lower scores are cut off to 0
+    title_sims = process.cdist(titles_1, titles_2, scorer=Indel.normalized_similarity, score_cutoff=0.2,
+                               workers=-1)
+    # entries without a title cannot be compared by their title, so they must not count as identical titles
+    title_sims[[i for i, title in enumerate(titles_1) if not title], :] = 0
+    title_sims[:, [j for j, title in enumerate(titles_2) if not title]] = 0
+
+    # compare authors with token set similarity of their last names
+    author_sims = process.cdist(names_1, names_2, scorer=fuzz.token_set_ratio, workers=-1) / 100.0
 
     # compare all other fields as a bag of words
-    def get_all_fields(entry) -> str:
-        texts = ''
-        for key in list(entry.fields.keys()):
-            texts = texts + entry.fields[key] + ' '
-        return texts[:-1]
-
-    bow_sims = {}
-    vectorizer = TfidfVectorizer(stop_words='english')
-    for k1 in b_keys_1:
-        text_k1 = get_all_fields(b_file_1.entries[k1])
-        for k2 in b_keys_2:
-            text_k2 = get_all_fields(b_file_2.entries[k2])
-            tfidf = vectorizer.fit_transform([text_k1, text_k2])
-            bow_sims[(k1, k2)] = (tfidf * tfidf.T).A[0, 1]
-
-    # aggregate similarities
-    agg_sims = {}
-    for k1 in b_keys_1:
-        for k2 in b_keys_2:
-            agg_sims[(k1, k2)] = 0.375 * title_sims[(k1, k2)] \
-                                 + 0.375 * author_sims[(k1, k2)] \
-                                 + 0.25 * bow_sims[(k1, k2)]
-
-    # delete all entries below a certain threshold
-    for key in list(agg_sims):
-        if agg_sims[key] < 0.7:
-            del agg_sims[key]
-
-    # select the best matches for each entry
-    matches = []
-    for k1 in b_keys_1:
-        entries = []
-        for k2 in b_keys_2:
-            if (k1, k2) in agg_sims:
-                entries.append((k1, k2, agg_sims[(k1, k2)]))
-        if len(entries) > 0:
-            entries.sort(key=lambda a: a[2], reverse=True)  # sort for highest similarity in front
-            matches.append((entries[0][0], entries[0][1]))
-            for e in entries:
-                del agg_sims[(e[0], e[1])]
+    # hashed term counts need no vocabulary; rows are l2-normalized, so the dot product is the cosine similarity
+    vectorizer = HashingVectorizer(stop_words='english', n_features=2 ** 18, alternate_sign=False, norm=None)
+    tfidf = TfidfTransformer(norm='l2', sublinear_tf=True).fit_transform(vectorizer.transform(texts_1 + texts_2))
+    tfidf_1, tfidf_2 = tfidf[:len(texts_1)], tfidf[len(texts_1):]
+    # the sparse product is densified in blocks of rows to bound the memory of the intermediate result
+    bow_sims = np.empty((tfidf_1.shape[0], tfidf_2.shape[0]))
+    for start in range(0, tfidf_1.shape[0], 1024):
+        bow_sims[start:start + 1024] = (tfidf_1[start:start + 1024] @ tfidf_2.T).toarray()
+
+    # aggregate similarities (in place to avoid temporary matrices)
+    agg_sims = np.multiply(title_sims, 0.375, dtype=np.float64)
+    author_sims *= 0.375
+    agg_sims += author_sims
+    bow_sims *= 0.25
+    agg_sims += bow_sims
+
+    # select an optimal one-to-one assignment of entries, ignoring pairs below a certain threshold
+    # (the bag-of-words matrix is no longer needed and is reused for the costs)
+    cost = np.negative(agg_sims, out=bow_sims)
+    cost[agg_sims < 0.7] = 0
+    assigned_rows, assigned_cols = linear_sum_assignment(cost)
+    matches = [(b_keys_1[r], b_keys_2[c]) for r, c in zip(assigned_rows, assigned_cols) if agg_sims[r, c] >= 0.7]
 
     serialize_bibtex_entries(matches, b_file_1, b_file_2, path_output, prefer_second, dry_run)
 
@@ -257,8 +355,9 @@ def merge_bibtex():
     if args.only_identical:
         process_identical_keys(bib_file_1, bib_file_2, args.output, args.prefer_second, args.dry_run)
     else:
-        nltk.download('stopwords')
-        process_similar_keys(bib_file_1, bib_file_2, args.output, args.prefer_second, args.dry_run)
+        # the preprocessed entries are only cached on disk if files may be created
+        paths_bib = (None, None) if args.dry_run else (args.bib_file_1, args.bib_file_2)
+        process_similar_keys(bib_file_1, bib_file_2, args.output, args.prefer_second, args.dry_run, *paths_bib)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,15 @@
+import os
+import pickle
+import re
+import tempfile
 import unittest
+from unittest import mock
 
 import nltk
+from pybtex.database import BibliographyData, Entry, Person
 from pybtex.database.input import bibtex
 
-from merge_bibtex import process_identical_keys, process_similar_keys, parse_bibtex_files
+from merge_bibtex import process_identical_keys, process_similar_keys, parse_bibtex_files, preprocess_entries
 
 
 class MergeBibtexTest(unittest.TestCase):
@@ -44,6 +50,107 @@ class MergeBibtexTest(unittest.TestCase):
         self.assertIsNotNone(bib_file_output)
         self.assertSetEqual({'smit55', 'colu92', 'phil98', 'jame76', 'gree00'}, set(bib_file_output.entries.keys()))
 
+    def test_processing_similar_entries_one_to_one(self):
+        # load bib data where the first file contains a copy of an entry under another key
+        bib_file_1 = bibtex.Parser().parse_file('test/resources/testbib_1.bib')
+        bib_file_2 = bibtex.Parser().parse_file('test/resources/testbib_2.bib')
+        entry = bib_file_1.entries['smit54']
+        bib_file_1.add_entry('smit53', Entry(entry.type, fields=dict(entry.fields), persons=entry.persons))
+
+        process_similar_keys(bib_file_1, bib_file_2, 'test/resources/testbib_output.bib', False, False)
+
+        # check the written keys, only one of the copies may be matched with the entry of the second file
+        with open('test/resources/testbib_output.bib', encoding='utf-8') as f:
+            written_keys = re.findall(r'^@\w+\{([^,]+),', f.read(), re.MULTILINE)
+        self.assertEqual(len(set(written_keys)), len(written_keys))
+        self.assertEqual(1, len({'smit53', 'smit54'}.intersection(written_keys)))
+
+        # load output bib
+        bib_file_output = bibtex.Parser().parse_file('test/resources/testbib_output.bib')
+        self.assertIsNotNone(bib_file_output)
+        self.assertEqual(5, len(bib_file_output.entries))
+
+    def test_processing_similar_entries_with_empty_file(self):
+        bib_file_1 = bibtex.Parser().parse_file('test/resources/testbib_1.bib')
+
+        process_similar_keys(bib_file_1, BibliographyData(), 'test/resources/testbib_output.bib', False, False)
+
+        # load output bib
+        bib_file_output = bibtex.Parser().parse_file('test/resources/testbib_output.bib')
+        self.assertIsNotNone(bib_file_output)
+        self.assertEqual(0, len(bib_file_output.entries))
+
+    def test_processing_similar_entries_without_title(self):
+        bib_file_1 = BibliographyData({'smit00': Entry('misc', fields={'year': '2000', 'howpublished': 'Talk'},
+                                                       persons={'author': [Person('Smith, John')]})})
+        bib_file_2 = BibliographyData({'smit11': Entry('misc', fields={'year': '2011', 'note': 'Software'},
+                                                       persons={'author': [Person('Smith, John')]})})
+
+        process_similar_keys(bib_file_1, bib_file_2, 'test/resources/testbib_output.bib', False, False)
+
+        # load output bib
+        bib_file_output = bibtex.Parser().parse_file('test/resources/testbib_output.bib')
+        self.assertIsNotNone(bib_file_output)
+        self.assertEqual(0, len(bib_file_output.entries))
+
+    def test_preprocessing_entry_without_title_and_author(self):
+        bib_file = BibliographyData({'misc00': Entry('misc', fields={'year': '2000'})})
+
+        titles, names, texts = preprocess_entries(bib_file)
+        self.assertEqual([''], titles)
+        self.assertEqual([''], names)
+        self.assertEqual(['2000'], texts)
+
+    def test_preprocessing_with_cache(self):
+        bib_file_1 = bibtex.Parser().parse_file('test/resources/testbib_1.bib')
+
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch('merge_bibtex._CACHE_DIR', cache_dir):
+            features = preprocess_entries(bib_file_1, 'test/resources/testbib_1.bib')
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+
+            # the second call is served from the cache
+            with mock.patch('merge_bibtex.cleanup_text') as cleanup_text:
+                self.assertEqual(features, preprocess_entries(bib_file_1, 'test/resources/testbib_1.bib'))
+                cleanup_text.assert_not_called()
+
+        self.assertEqual(features, preprocess_entries(bib_file_1))
+
+    def test_preprocessing_with_corrupted_cache(self):
+        bib_file_1 = bibtex.Parser().parse_file('test/resources/testbib_1.bib')
+        features = preprocess_entries(bib_file_1)
+
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch('merge_bibtex._CACHE_DIR', cache_dir):
+            preprocess_entries(bib_file_1, 'test/resources/testbib_1.bib')
+            cache_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+
+            # invalid pickle data and wrongly shaped features are both recomputed
+            for content in [b'\x80\x04corrupted', pickle.dumps((['title'], [], []))]:
+                with open(cache_path, 'wb') as f:
+                    f.write(content)
+                self.assertEqual(features, preprocess_entries(bib_file_1, 'test/resources/testbib_1.bib'))
+
+            self.assertEqual([os.path.basename(cache_path)], os.listdir(cache_dir))
+
+    def test_preprocessing_with_failing_cache_write(self):
+        bib_file_1 = bibtex.Parser().parse_file('test/resources/testbib_1.bib')
+
+        # e.g. a full disk, no temporary file must be left behind
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch('merge_bibtex._CACHE_DIR', cache_dir), \
+                mock.patch('merge_bibtex.pickle.dump', side_effect=OSError):
+            features = preprocess_entries(bib_file_1, 'test/resources/testbib_1.bib')
+            self.assertEqual([], os.listdir(cache_dir))
+
+        self.assertEqual(features, preprocess_entries(bib_file_1))
+
+    def test_preprocessing_with_unwritable_cache(self):
+        bib_file_1 = bibtex.Parser().parse_file('test/resources/testbib_1.bib')
+
+        # the cache directory cannot be created below a regular file
+        with tempfile.NamedTemporaryFile() as f, mock.patch('merge_bibtex._CACHE_DIR', os.path.join(f.name, 'cache')):
+            features = preprocess_entries(bib_file_1, 'test/resources/testbib_1.bib')
+
+        self.assertEqual(features, preprocess_entries(bib_file_1))
+
     def test_processing_without_overwrite(self):
         self.assertRaises(FileExistsError,
                           lambda: parse_bibtex_files('test/resources/testbib_1.bib', 'test/resources/testbib_2.bib',